@@ -17,13 +17,14 @@ def main():
     parser.add_argument("--provider", type=str, choices=["offline", "openai"], default="offline")
     parser.add_argument("--model", type=str, default="gpt-4o-mini")
     parser.add_argument("--json", action="store_true", help="Print JSON output")
+    parser.add_argument("--no-cache", action="store_true", help="Rebuild the index instead of using the on-disk cache")
 
     args = parser.parse_args()
     use_openai = args.provider == "openai"
 
-    pipe = RAGPipeline(args.data, use_openai=use_openai, model=args.model)
-    pipe.build()
-    res = pipe.query(args.query, k=args.k)
+    with RAGPipeline(args.data, use_openai=use_openai, model=args.model, use_cache=not args.no_cache) as pipe:
+        pipe.build()
+        res = pipe.query(args.query, k=args.k)
 
     if args.json:
         print(json.dumps(res, indent=2))
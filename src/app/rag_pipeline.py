@@ -1,15 +1,63 @@
+import asyncio
+import hashlib
+import mmap
 import os
 import re
+import sys
+import tempfile
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, TypedDict, Any
+from typing import List, Tuple, Optional, Callable, Deque, Dict, TypedDict, Any
 
+import joblib
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-
-
-@dataclass
+import sklearn
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+
+_WORD_RE = re.compile(r"\w+")
+_SENT_SPLIT = re.compile(r"(?<=[.!?])\s+")
+# Files at least this large are memory-mapped instead of read into a bytes buffer.
+_MMAP_MIN_BYTES = 64 * 1024
+# Bump when the on-disk index format changes so stale caches are ignored.
+_CACHE_VERSION = 7
+
+
+def _default_cache_dir() -> Path:
+    """Per-user cache location, kept out of the corpus folder."""
+    if sys.platform == "win32":
+        base = os.getenv("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    else:
+        base = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "simple-offline-rag"
+
+
+def _fingerprint(paths: List[Path], block_size: int = 1 << 20) -> str:
+    """Hash file names and contents, streaming each file in fixed-size blocks."""
+    h = hashlib.blake2b(digest_size=16)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    for p in sorted(paths):
+        with open(p, "rb") as f:
+            h.update(f"{p.name}\0{os.fstat(f.fileno()).st_size}\0".encode("utf-8"))
+            while n := f.readinto(buf):
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+def _split_sentences(text: str) -> List[Tuple[str, frozenset]]:
+    """Split text into stripped, non-empty sentences paired with their word sets."""
+    out = []
+    for sent in _SENT_SPLIT.split(text.strip()):
+        s = sent.strip()
+        if s:
+            out.append((s, frozenset(_WORD_RE.findall(s.lower()))))
+    return out
+
+
+@dataclass(slots=True, frozen=True)
 class Chunk:
     doc_id: str
     chunk_id: int
@@ -24,40 +72,142 @@ class LocalCorpus:
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
 
+    def files(self) -> List[Path]:
+        return sorted(self.data_dir.glob("*.txt"))
+
     def load(self) -> List[Chunk]:
         chunks: List[Chunk] = []
-        for p in sorted(self.data_dir.glob("*.txt")):
-            text = p.read_text(encoding="utf-8", errors="ignore")
-            for i, ch in enumerate(self._split_text(text)):
-                chunks.append(Chunk(doc_id=p.name, chunk_id=i, text=ch))
+        paths = self.files()
+        if not paths:
+            return chunks
+        # Reads run on a thread pool so the next files are fetched while the
+        # current one is being split. At most `workers` reads are in flight, so
+        # only a bounded window of decoded files is held in memory at once.
+        workers = min(32, (os.cpu_count() or 1) * 4, len(paths))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending: Deque[Future] = deque(pool.submit(self._read_text, p) for p in paths[:workers])
+            for n, p in enumerate(paths):
+                text = pending.popleft().result()
+                if n + workers < len(paths):
+                    pending.append(pool.submit(self._read_text, paths[n + workers]))
+                for i, ch in enumerate(self._split_text(text)):
+                    chunks.append(Chunk(doc_id=p.name, chunk_id=i, text=ch))
         return chunks
 
+    @staticmethod
+    def _read_text(path: Path) -> str:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < _MMAP_MIN_BYTES:
+                return f.read().decode("utf-8", errors="ignore")
+            # Decode straight from the mapped pages so the raw bytes never get a
+            # private heap copy next to the decoded str.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                return str(view, "utf-8", "ignore")
+
     def _split_text(self, text: str) -> List[str]:
-        text = re.sub(r"\s+", " ", text).strip()
+        # str.split() collapses runs of whitespace and drops the ends in one C pass
+        text = " ".join(text.split())
         if not text:
             return []
-        step = max(1, self.chunk_size - self.chunk_overlap)
-        return [text[i : i + self.chunk_size] for i in range(0, len(text), step)]
+        size = self.chunk_size
+        step = max(1, size - self.chunk_overlap)
+        return [text[i : i + size] for i in range(0, len(text), step)]
 
 
 class TfidfIndex:
     def __init__(self):
-        self.vectorizer: Optional[TfidfVectorizer] = None
+        self.hasher: Optional[HashingVectorizer] = None
+        self.tfidf: Optional[TfidfTransformer] = None
         self.matrix = None
-        self.chunks: List[Chunk] = []
+        # Chunk metadata is kept as parallel arrays (row i of the matrix is
+        # chunk i); Chunk objects are only materialised for search results.
+        self.doc_ids: np.ndarray = np.empty(0, dtype=object)
+        self.chunk_ids: np.ndarray = np.empty(0, dtype=np.int32)
+        self.texts: List[str] = []
+        # Sentences and word sets per answered chunk, filled lazily by sentences()
+        self._sentences: Dict[Tuple[str, int], List[Tuple[str, frozenset]]] = {}
+
+    def chunk(self, i: int) -> Chunk:
+        return Chunk(doc_id=self.doc_ids[i], chunk_id=int(self.chunk_ids[i]), text=self.texts[i])
 
     def build(self, chunks: List[Chunk]):
-        self.chunks = chunks
-        docs = [c.text for c in chunks]
-        self.vectorizer = TfidfVectorizer(ngram_range=(1, 2), min_df=1, max_df=0.9)
-        self.matrix = self.vectorizer.fit_transform(docs)
+        self.doc_ids = np.array([c.doc_id for c in chunks], dtype=object)
+        self.chunk_ids = np.array([c.chunk_id for c in chunks], dtype=np.int32)
+        self.texts = [c.text for c in chunks]
+        self._sentences = {}
+        # Feature hashing keeps memory fixed (no vocabulary dict) at the cost of
+        # rare collisions across 2**20 buckets. float32 halves the matrix values.
+        self.hasher = HashingVectorizer(
+            ngram_range=(1, 2), n_features=2**20, alternate_sign=False, norm=None, dtype=np.float32
+        )
+        counts = self.hasher.transform(self.texts)
+        self.tfidf = TfidfTransformer()
+        self.tfidf.fit(counts)
+        # Zero the idf of buckets never seen in the corpus (so unseen query terms
+        # are ignored, as with a vocabulary) and of terms in more than 90% of
+        # chunks (the previous max_df=0.9).
+        df = np.bincount(counts.indices, minlength=counts.shape[1])
+        idf = self.tfidf.idf_
+        idf[(df == 0) | (df > 0.9 * counts.shape[0])] = 0.0
+        self.tfidf.idf_ = idf
+        # Rows are L2-normalised (norm="l2"), so a plain dot product against
+        # the query vector is already the cosine similarity.
+        self.matrix = self.tfidf.transform(counts).tocsr()
+
+    def save(self, path: Path):
+        state = (self.hasher, self.tfidf, self.matrix, self.doc_ids, self.chunk_ids, self.texts)
+        # Write to a unique temp file and rename, so concurrent builds never
+        # share a partial file; the temp file is removed if anything fails.
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix=".tmp", delete=False) as f:
+            tmp = Path(f.name)
+        try:
+            # compress=0 keeps the sparse matrix arrays raw so load() can mmap them.
+            joblib.dump(state, tmp, compress=0)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def load(self, path: Path):
+        state = joblib.load(path, mmap_mode="r")
+        self.hasher, self.tfidf, self.matrix, self.doc_ids, self.chunk_ids, self.texts = state
+        self._sentences = {}
+
+    def sentences(self, chunk: Chunk) -> List[Tuple[str, frozenset]]:
+        """Split and tokenize a chunk's sentences once, reusing them for later queries."""
+        key = (chunk.doc_id, chunk.chunk_id)
+        sents = self._sentences.get(key)
+        if sents is None:
+            sents = self._sentences[key] = _split_sentences(chunk.text)
+        return sents
+
+    def vectorize(self, query: str):
+        assert self.hasher is not None and self.tfidf is not None, "Index not built"
+        return self.tfidf.transform(self.hasher.transform([query]))
 
     def search(self, query: str, k: int = 4) -> List[Tuple[Chunk, float]]:
-        assert self.vectorizer is not None and self.matrix is not None, "Index not built"
-        qv = self.vectorizer.transform([query])
-        sims = cosine_similarity(qv, self.matrix)[0]
-        idxs = np.argsort(-sims)[:k]
-        return [(self.chunks[i], float(sims[i])) for i in idxs]
+        return self.search_vector(self.vectorize(query), k=k)
+
+    def search_vector(self, qv, k: int = 4) -> List[Tuple[Chunk, float]]:
+        idxs, sims = self.top_rows(qv, k=k)
+        return [(self.chunk(i), float(s)) for i, s in zip(idxs, sims)]
+
+    def top_rows(self, qv, k: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the row indices of the k best chunks and their scores, best first."""
+        assert self.matrix is not None, "Index not built"
+        sims = (self.matrix @ qv.T).toarray().ravel()
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=sims.dtype)
+        if k < len(sims):
+            # O(N) partition to the k best, then sort only those k.
+            # Rows tied at the cut-off score are taken in corpus order.
+            kth = sims[np.argpartition(sims, -k)[-k]]
+            above = np.flatnonzero(sims > kth)
+            part = np.concatenate((above, np.flatnonzero(sims == kth)[: k - len(above)]))
+        else:
+            part = np.arange(len(sims))
+        # Order by score, breaking ties by row so equal scores keep corpus order.
+        idxs = part[np.lexsort((part, -sims[part]))]
+        return idxs, sims[idxs]
 
 
 class OfflineAnswerer:
@@ -69,42 +219,71 @@ class OfflineAnswerer:
     - Produce a concise answer with inline citations [doc#chunk].
     """
 
-    def __init__(self, max_context_chars: int = 2000):
+    def __init__(
+        self,
+        max_context_chars: int = 2000,
+        max_sentences: int = 5,
+        sentence_source: Optional[Callable[[Chunk], List[Tuple[str, frozenset]]]] = None,
+    ):
         self.max_context_chars = max_context_chars
+        self.max_sentences = max_sentences
+        # Where to get a chunk's tokenized sentences (e.g. TfidfIndex.sentences);
+        # defaults to splitting the chunk text on every call.
+        self.sentence_source = sentence_source or (lambda ch: _split_sentences(ch.text))
+
+    @staticmethod
+    def _add_sentence(picked: List[Tuple[str, Chunk]], sent: str, ch: Chunk) -> bool:
+        """Append `sent` unless it repeats a picked sentence from the same document.
+
+        Neighbouring chunks overlap, so a chunk often starts with the cut-off
+        tail of a sentence already taken from the previous chunk. A fragment
+        contained in a picked sentence is skipped; a full sentence containing
+        an earlier-picked fragment replaces it in place.
+        """
+        for i, (p, pch) in enumerate(picked):
+            if pch.doc_id != ch.doc_id:
+                continue
+            if sent in p:
+                return False
+            if p in sent:
+                picked[i] = (sent, ch)
+                return False
+        picked.append((sent, ch))
+        return True
 
     def answer(self, query: str, hits: List[Tuple[Chunk, float]]) -> str:
         if not hits:
             return "I couldn't find anything relevant in the local corpus."
-        # Build context
-        context = ""
+        # Build context from the top hits that fit the budget
+        used = 0
         chosen: List[Tuple[Chunk, float]] = []
         for ch, score in hits:
             snippet = ch.text.strip()
-            if len(context) + len(snippet) + 1 > self.max_context_chars:
+            if used + len(snippet) + 1 > self.max_context_chars:
                 break
-            context += ("\n" if context else "") + snippet
+            used += len(snippet) + (1 if used else 0)
             chosen.append((ch, score))
 
-        # Extractive summary: pick sentences containing query terms
-        terms = set(re.findall(r"\w+", query.lower()))
-        sentences = re.split(r"(?<=[.!?])\s+", context)
+        # Extractive summary: pick sentences containing query terms. Chunks are
+        # in retrieval-score order, so the first matches are the best ones.
+        terms = frozenset(_WORD_RE.findall(query.lower()))
+        min_overlap = max(1, round(0.2 * max(len(terms), 1)))
         picked: List[Tuple[str, Chunk]] = []
-        for sent in sentences:
-            toks = set(re.findall(r"\w+", sent.lower()))
-            if len(terms & toks) >= max(1, round(0.2 * max(len(terms), 1))):
-                # map sentence back to the first chunk that contains it
-                for ch, _ in chosen:
-                    if sent.strip() and sent.strip() in ch.text:
-                        picked.append((sent.strip(), ch))
+        for ch, _ in chosen:
+            for s, toks in self.sentence_source(ch):
+                if len(terms & toks) >= min_overlap and self._add_sentence(picked, s, ch):
+                    if len(picked) >= self.max_sentences:
                         break
+            if len(picked) >= self.max_sentences:
+                break
 
         if not picked:
             # fallback: first sentence of the top chunk
             top_ch, _ = chosen[0]
-            picked = [(re.split(r"(?<=[.!?])\s+", top_ch.text.strip())[0], top_ch)]
+            picked = [(_SENT_SPLIT.split(top_ch.text.strip())[0], top_ch)]
 
         lines = []
-        for sent, ch in picked[:5]:
+        for sent, ch in picked:
             cite = f"[{ch.doc_id}#{ch.chunk_id}]"
             lines.append(f"- {sent} {cite}")
 
@@ -121,24 +300,30 @@ class OpenAIAnswerer:
     """
 
     def __init__(self, model: str = "gpt-4o-mini"):
+        import httpx
+
         self.model = model
         self.api_key = os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise RuntimeError("OPENAI_API_KEY not set. Use OfflineAnswerer or set the key.")
+        # One keep-alive client per answerer so repeated queries reuse the TLS connection
+        self._client = httpx.Client(timeout=30, limits=httpx.Limits(keepalive_expiry=60))
 
-    def answer(self, query: str, hits: List[Tuple[Chunk, float]]) -> str:
-        import httpx
+    def close(self):
+        self._client.close()
 
-        context_parts = []
-        for ch, score in hits:
-            context_parts.append(f"[{ch.doc_id}#{ch.chunk_id}]\n{ch.text.strip()}")
-        context = "\n\n".join(context_parts[:6])
+    def _request(self, query: str, hits: List[Tuple[Chunk, float]]) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
+        # Keep the best 6 hits but order them by source, so queries that retrieve
+        # overlapping chunks send an identical prompt prefix (provider-side prefix caching).
+        top = sorted(hits[:6], key=lambda h: (h[0].doc_id, h[0].chunk_id))
+        context = "\n\n".join(f"[{ch.doc_id}#{ch.chunk_id}]\n{ch.text.strip()}" for ch, _ in top)
 
         system = (
             "You are a helpful assistant. Answer using ONLY the provided context. "
             "Cite sources inline like [doc#chunk]. If information is missing, say so."
         )
-        user = f"Question: {query}\n\nContext:\n{context}"
+        # Invariant material first, the per-query question last
+        user = f"Context:\n{context}\n\nQuestion: {query}"
 
         payload = {
             "model": self.model,
@@ -151,34 +336,193 @@ class OpenAIAnswerer:
         headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
         # Using the Chat Completions endpoint (compatible with OpenAI-compatible providers)
         url = "https://api.openai.com/v1/chat/completions"
-        with httpx.Client(timeout=30) as client:
-            resp = client.post(url, json=payload, headers=headers)
-            resp.raise_for_status()
-            data = resp.json()
-            content = data["choices"][0]["message"]["content"].strip()
-        return content
+        return url, payload, headers
+
+    @staticmethod
+    def _content(resp) -> str:
+        resp.raise_for_status()
+        data = resp.json()
+        return data["choices"][0]["message"]["content"].strip()
+
+    def answer(self, query: str, hits: List[Tuple[Chunk, float]]) -> str:
+        url, payload, headers = self._request(query, hits)
+        return self._content(self._client.post(url, json=payload, headers=headers))
+
+    def _async_client(self, max_connections: int):
+        import httpx
+
+        # No pool timeout: queued requests wait for a free connection instead of
+        # failing while earlier (slow) completions are still running.
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(30, pool=None), limits=httpx.Limits(max_connections=max_connections)
+        )
+
+    async def answer_batch_async(
+        self, pairs: List[Tuple[str, List[Tuple[Chunk, float]]]], max_connections: int = 16
+    ) -> List[str | Exception]:
+        """Answer several (query, hits) pairs concurrently; results keep input order.
+
+        At most `max_connections` requests are in flight. A request that fails
+        yields its exception in place of the answer, so one bad response does
+        not discard the rest of the batch.
+        """
+        requests = [self._request(q, hits) for q, hits in pairs]
+        limit = asyncio.Semaphore(max_connections)
+
+        async def post(client, url: str, payload: Dict[str, Any], headers: Dict[str, str]) -> str:
+            async with limit:
+                resp = await client.post(url, json=payload, headers=headers)
+            return self._content(resp)
+
+        async with self._async_client(max_connections) as client:
+            return await asyncio.gather(
+                *(post(client, url, payload, headers) for url, payload, headers in requests),
+                return_exceptions=True,
+            )
+
+    def answer_batch(
+        self, pairs: List[Tuple[str, List[Tuple[Chunk, float]]]], max_connections: int = 16
+    ) -> List[str | Exception]:
+        """Blocking wrapper around answer_batch_async (not usable inside a running event loop)."""
+        return asyncio.run(self.answer_batch_async(pairs, max_connections=max_connections))
+
+
+class QueryCache:
+    """LRU cache of query results keyed on the query's word set and k.
+
+    A hit also needs cosine similarity >= threshold between the TF-IDF
+    vectors, which separates queries with the same words in a different
+    order. The word set is part of the key because words unseen in the
+    corpus have zero weight: "RAG" and "RAG for lawyers" have identical
+    vectors but are different questions.
+    """
+
+    def __init__(self, max_size: int = 0, threshold: float = 0.95):
+        self.max_size = max_size
+        self.threshold = threshold
+        self._entries: "OrderedDict[Tuple[frozenset, int], Tuple[Any, QueryResult]]" = OrderedDict()
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, qv, k: int, terms: frozenset) -> Optional["QueryResult"]:
+        if self.max_size <= 0 or qv.nnz == 0:
+            return None
+        entry = self._entries.get((terms, k))
+        if entry is None:
+            return None
+        cached_qv, result = entry
+        if qv.multiply(cached_qv).sum() < self.threshold:
+            return None
+        self._entries.move_to_end((terms, k))
+        return result
+
+    def put(self, qv, k: int, terms: frozenset, result: "QueryResult"):
+        if self.max_size <= 0 or qv.nnz == 0:
+            return
+        self._entries[(terms, k)] = (qv, result)
+        self._entries.move_to_end((terms, k))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
 
 
 class RAGPipeline:
-    def __init__(self, data_dir: str | Path, use_openai: bool = False, model: str = "gpt-4o-mini"):
+    def __init__(
+        self,
+        data_dir: str | Path,
+        use_openai: bool = False,
+        model: str = "gpt-4o-mini",
+        cache_dir: str | Path | None = None,
+        use_cache: bool = True,
+        query_cache_size: int = 0,
+    ):
         self.corpus = LocalCorpus(data_dir)
         self.index = TfidfIndex()
-        self.answerer = OpenAIAnswerer(model) if use_openai else OfflineAnswerer()
+        self.answerer = (
+            OpenAIAnswerer(model) if use_openai else OfflineAnswerer(sentence_source=self.index.sentences)
+        )
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else _default_cache_dir()
+        self.use_cache = use_cache
+        self.query_cache = QueryCache(max_size=query_cache_size)
+
+    def close(self):
+        """Release the answerer's resources (the OpenAI keep-alive connection)."""
+        close = getattr(self.answerer, "close", None)
+        if close is not None:
+            close()
+
+    def __enter__(self) -> "RAGPipeline":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cache_prefix(self) -> str:
+        # One prefix per (data dir, chunking) pair: pruning only touches files
+        # this pipeline configuration wrote.
+        source = repr((str(self.corpus.data_dir.resolve()), self.corpus.chunk_size, self.corpus.chunk_overlap))
+        return f"tfidf-index-{hashlib.blake2b(source.encode('utf-8'), digest_size=8).hexdigest()}"
+
+    def _cache_path(self) -> Path:
+        # Library versions are part of the key: pickles are not portable across them.
+        versions = f"{_CACHE_VERSION}-{sklearn.__version__}-{joblib.__version__}"
+        return self.cache_dir / f"{self._cache_prefix()}-{_fingerprint(self.corpus.files())}-{versions}.joblib"
+
+    def _load_cached(self, cache_path: Path) -> bool:
+        if not cache_path.exists():
+            return False
+        try:
+            self.index.load(cache_path)
+            return True
+        except Exception as e:  # corrupt or incompatible pickle: drop it and rebuild
+            warnings.warn(f"Ignoring unreadable index cache {cache_path}: {e}")
+            cache_path.unlink(missing_ok=True)
+            return False
+
+    def _save_cached(self, cache_path: Path):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.index.save(cache_path)
+        except Exception as e:  # e.g. unwritable cache dir; the cache is optional
+            warnings.warn(f"Could not write index cache {cache_path}: {e}")
+            return
+        # Only the current corpus state is worth keeping
+        for old in self.cache_dir.glob(f"{self._cache_prefix()}-*.joblib"):
+            if old != cache_path:
+                try:
+                    old.unlink()
+                except OSError:
+                    pass
 
     def build(self):
+        self.query_cache.clear()
+        cache_path = None
+        if self.use_cache:
+            cache_path = self._cache_path()
+            if self._load_cached(cache_path):
+                return
         chunks = self.corpus.load()
         if not chunks:
             raise RuntimeError("No .txt files found in data directory.")
         self.index.build(chunks)
+        if cache_path is not None:
+            self._save_cached(cache_path)
 
     def query(self, q: str, k: int = 4) -> "QueryResult":
-        hits = self.index.search(q, k=k)
+        qv = self.index.vectorize(q)
+        terms = frozenset(_WORD_RE.findall(q.lower()))
+        cached = self.query_cache.get(qv, k, terms)
+        if cached is not None:
+            return _copy_result(cached)
+        hits = self.index.search_vector(qv, k=k)
         answer = self.answerer.answer(q, hits)
         sources: List[SourceDict] = [
             SourceDict(doc=ch.doc_id, chunk=ch.chunk_id, score=float(score), preview=ch.text[:160])
             for ch, score in hits
         ]
-        return QueryResult(answer=answer, sources=sources)
+        result = QueryResult(answer=answer, sources=sources)
+        self.query_cache.put(qv, k, terms, _copy_result(result))
+        return result
 
 
 class SourceDict(TypedDict):
@@ -192,3 +536,7 @@ class QueryResult(TypedDict):
     answer: str
     sources: List[SourceDict]
 
+
+def _copy_result(res: QueryResult) -> QueryResult:
+    return QueryResult(answer=res["answer"], sources=[SourceDict(**s) for s in res["sources"]])
+
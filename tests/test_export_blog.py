@@ -0,0 +1,44 @@
+import importlib.util
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+_spec = importlib.util.spec_from_file_location("export_blog", ROOT / "tools" / "export_blog.py")
+export_blog = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(export_blog)
+
+
+def test_classify_lines():
+    eb = export_blog
+    md = "\n".join(
+        [
+            "# Title",
+            "## Section",
+            "### Sub",
+            "#### Too deep",
+            "- dash item",
+            "* star item",
+            "  - indented",
+            "*bold*",
+            "",
+            "Plain text",
+            "```python",
+            "x = 1",
+            "```",
+            "```",
+            "never closed",
+        ]
+    )
+    assert eb.classify_lines(md) == [
+        (eb.H1, "Title"),
+        (eb.H2, "Section"),
+        (eb.H3, "Sub"),
+        (eb.TEXT, "#### Too deep"),
+        (eb.BULLET, "dash item"),
+        (eb.BULLET, "star item"),
+        (eb.TEXT, "  - indented"),
+        (eb.TEXT, "*bold*"),
+        (eb.BLANK, ""),
+        (eb.TEXT, "Plain text"),
+        (eb.CODE, "x = 1"),
+    ]
@@ -1,23 +1,50 @@
+import asyncio
+import importlib
 import json
 import sys
 from pathlib import Path
 
+import httpx
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from sklearn.metrics.pairwise import cosine_similarity
+
 # Ensure workspace root (parent of 'src') is on sys.path for imports
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
-from src.app.rag_pipeline import RAGPipeline
+from src.app import rag_pipeline
+from src.app.rag_pipeline import (
+    _MMAP_MIN_BYTES,
+    Chunk,
+    LocalCorpus,
+    OfflineAnswerer,
+    OpenAIAnswerer,
+    QueryCache,
+    RAGPipeline,
+    TfidfIndex,
+)
 
 
-def test_pipeline_offline_basic(tmp_path: Path):
+@pytest.fixture
+def corpus_dir(tmp_path: Path) -> Path:
     # Create a small temp corpus
     d = tmp_path / "data"
     d.mkdir()
     (d / "a.txt").write_text("RAG retrieves documents. It reduces hallucinations.")
     (d / "b.txt").write_text("TF-IDF is a classic retrieval method using term weights.")
+    return d
+
+
+@pytest.fixture
+def openai_key(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
 
-    pipe = RAGPipeline(d, use_openai=False)
+
+def test_pipeline_offline_basic(corpus_dir: Path):
+    pipe = RAGPipeline(corpus_dir, use_openai=False)
     pipe.build()
 
     res = pipe.query("What does RAG do?", k=3)
@@ -28,7 +55,262 @@ def test_pipeline_offline_basic(tmp_path: Path):
 
 def test_cli_import():
     # Ensure CLI imports without side effects
-    import importlib
-
     m = importlib.import_module("src.app.cli")
     assert hasattr(m, "main")
+
+
+def test_search_scores_match_cosine(corpus_dir: Path):
+    (corpus_dir / "c.txt").write_text("Chunking splits documents into overlapping windows.")
+
+    pipe = RAGPipeline(corpus_dir, use_openai=False)
+    pipe.build()
+
+    query = "retrieval of documents"
+    hits = pipe.index.search(query, k=2)
+    expected = cosine_similarity(pipe.index.vectorize(query), pipe.index.matrix)[0]
+    assert len(hits) == 2
+    assert [s for _, s in hits] == sorted((s for _, s in hits), reverse=True)
+    assert abs(hits[0][1] - expected.max()) < 1e-6
+
+
+def test_corpus_load_is_ordered(tmp_path: Path):
+    for n in range(12):
+        (tmp_path / f"doc{n:02d}.txt").write_text(f"Document number {n}. " * 50)
+
+    chunks = LocalCorpus(tmp_path, chunk_size=200, chunk_overlap=20).load()
+    doc_ids = [c.doc_id for c in chunks]
+    assert doc_ids == sorted(doc_ids)
+    assert len(set(doc_ids)) == 12
+    assert [c.chunk_id for c in chunks if c.doc_id == "doc00.txt"] == list(range(doc_ids.count("doc00.txt")))
+
+
+def test_corpus_load_large_file_matches_read_text(tmp_path: Path):
+    # Multi-byte UTF-8, invalid bytes and mixed whitespace, past the mmap threshold
+    unit = "Café naïve — 東京 résumé.\r\n\t".encode("utf-8") + b"\xff\xfe bad \xc3 bytes.  "
+    big = tmp_path / "big.txt"
+    big.write_bytes(unit * (_MMAP_MIN_BYTES // len(unit) + 10))
+    assert big.stat().st_size >= _MMAP_MIN_BYTES
+
+    corpus = LocalCorpus(tmp_path)
+    expected = corpus._split_text(big.read_text(encoding="utf-8", errors="ignore"))
+    chunks = corpus.load()
+    assert [c.text for c in chunks] == expected
+    assert [c.chunk_id for c in chunks] == list(range(len(expected)))
+
+
+def test_index_cache_roundtrip(corpus_dir: Path, tmp_path: Path):
+    cache = tmp_path / "cache"
+
+    first = RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache)
+    first.build()
+    assert len(list(cache.glob("*.joblib"))) == 1
+
+    second = RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache)
+    second.build()
+    assert second.query("What does RAG do?", k=2) == first.query("What does RAG do?", k=2)
+
+    # Rewriting identical content keeps the cache key
+    (corpus_dir / "a.txt").write_text("RAG retrieves documents. It reduces hallucinations.")
+    RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache).build()
+    assert len(list(cache.glob("*.joblib"))) == 1
+
+    old_files = list(cache.glob("*.joblib"))
+    (corpus_dir / "c.txt").write_text("A new document invalidates the cache.")
+    RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache).build()
+    new_files = list(cache.glob("*.joblib"))
+    # The stale index is pruned once the new one is saved
+    assert len(new_files) == 1 and new_files != old_files
+
+
+def test_index_cache_prunes_only_its_own_files(corpus_dir: Path, tmp_path: Path):
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    (cache / "model.joblib").write_text("unrelated")
+
+    small = RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache)
+    small.corpus.chunk_size = 20
+    small.build()
+    RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache).build()
+    small.build()
+
+    names = sorted(p.name for p in cache.iterdir())
+    assert "model.joblib" in names
+    assert len([n for n in names if n.startswith("tfidf-index-")]) == 2
+    assert not [n for n in names if n.endswith(".tmp")]
+
+
+def test_index_cache_save_failure_leaves_no_temp_file(corpus_dir: Path, tmp_path: Path, monkeypatch):
+    cache = tmp_path / "cache"
+
+    def fail(*args, **kwargs):
+        raise TypeError("cannot pickle")
+
+    monkeypatch.setattr(rag_pipeline.joblib, "dump", fail)
+    pipe = RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache)
+    with pytest.warns(UserWarning, match="Could not write index cache"):
+        pipe.build()
+    assert list(cache.iterdir()) == []
+    assert pipe.query("What does RAG do?", k=1)["sources"]
+
+
+def test_index_cache_recovers_from_bad_files(corpus_dir: Path, tmp_path: Path):
+    cache = tmp_path / "cache"
+    RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache).build()
+    (cache_file,) = cache.glob("*.joblib")
+    cache_file.write_bytes(b"not a pickle")
+
+    pipe = RAGPipeline(corpus_dir, use_openai=False, cache_dir=cache)
+    with pytest.warns(UserWarning, match="unreadable index cache"):
+        pipe.build()
+    assert "a.txt" == pipe.query("What does RAG do?", k=1)["sources"][0]["doc"]
+    assert cache_file.read_bytes() != b"not a pickle"
+
+    # An unwritable cache location only warns
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+    pipe = RAGPipeline(corpus_dir, use_openai=False, cache_dir=blocker / "cache")
+    with pytest.warns(UserWarning, match="Could not write index cache"):
+        pipe.build()
+    assert pipe.query("What does RAG do?", k=1)["sources"]
+
+
+def test_openai_answerer_stable_prompt(openai_key):
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(json.loads(request.content))
+        return httpx.Response(200, json={"choices": [{"message": {"content": " ok "}}]})
+
+    ans = OpenAIAnswerer()
+    ans.close()
+    ans._client = httpx.Client(transport=httpx.MockTransport(handler))
+    a, b = Chunk("a.txt", 0, "Alpha."), Chunk("b.txt", 1, "Beta.")
+
+    assert ans.answer("first?", [(b, 0.9), (a, 0.5)]) == "ok"
+    ans.answer("second?", [(a, 0.8), (b, 0.7)])
+    ans.close()
+    first, second = (p["messages"][1]["content"] for p in seen)
+    assert first.index("[a.txt#0]") < first.index("[b.txt#1]")
+    assert first.rsplit("Question:", 1)[0] == second.rsplit("Question:", 1)[0]
+
+
+def test_query_cache_reuses_repeated_queries(corpus_dir: Path):
+    pipe = RAGPipeline(corpus_dir, use_openai=False, use_cache=False, query_cache_size=16)
+    pipe.build()
+    calls = []
+    answer = pipe.answerer.answer
+    pipe.answerer.answer = lambda q, hits: calls.append(q) or answer(q, hits)
+
+    first = pipe.query("What does RAG do?", k=2)
+    assert pipe.query("what does rag do", k=2) == first
+    assert len(calls) == 1
+    pipe.query("What does RAG do?", k=1)
+    pipe.query("TF-IDF term weights", k=2)
+    assert len(calls) == 3
+
+    # Out-of-vocabulary words give the same TF-IDF vector but a different question
+    pipe.query("RAG", k=2)
+    oov = "RAG lawyers doctors nurses hospitals patients clinics surgeons"
+    assert pipe.index.vectorize(oov).multiply(pipe.index.vectorize("RAG")).sum() > 0.99
+    pipe.query(oov, k=2)
+    assert calls[-1] == oov
+
+
+def test_query_cache_evicts_least_recently_used():
+    qv = sp.csr_matrix(np.array([[1.0, 0.0]], dtype=np.float32))
+    cache = QueryCache(max_size=2)
+    for word in ("a", "b"):
+        cache.put(qv, 4, frozenset([word]), {"answer": word, "sources": []})
+    assert cache.get(qv, 4, frozenset(["a"]))["answer"] == "a"  # "a" is now most recent
+    cache.put(qv, 4, frozenset(["c"]), {"answer": "c", "sources": []})
+    assert cache.get(qv, 4, frozenset(["b"])) is None
+    assert cache.get(qv, 4, frozenset(["a"])) is not None
+    assert cache.get(qv, 3, frozenset(["a"])) is None
+
+
+def test_openai_answer_batch(openai_key, monkeypatch):
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        question = json.loads(request.content)["messages"][1]["content"].rsplit("Question: ", 1)[1]
+        return httpx.Response(200, json={"choices": [{"message": {"content": f"re: {question}"}}]})
+
+    ans = OpenAIAnswerer()
+    ans.close()  # only the async client is used
+    monkeypatch.setattr(ans, "_async_client", lambda n: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    hits = [(Chunk("a.txt", 0, "Alpha."), 1.0)]
+
+    assert ans.answer_batch([("one?", hits), ("two?", hits), ("three?", hits)]) == ["re: one?", "re: two?", "re: three?"]
+
+
+def test_openai_answer_batch_limits_concurrency_and_keeps_partial_results(openai_key, monkeypatch):
+    in_flight = peak = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        question = json.loads(request.content)["messages"][1]["content"].rsplit("Question: ", 1)[1]
+        if question == "bad?":
+            return httpx.Response(500)
+        return httpx.Response(200, json={"choices": [{"message": {"content": question}}]})
+
+    ans = OpenAIAnswerer()
+    ans.close()  # only the async client is used
+    monkeypatch.setattr(ans, "_async_client", lambda n: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    hits = [(Chunk("a.txt", 0, "Alpha."), 1.0)]
+    questions = [f"q{i}?" for i in range(10)] + ["bad?"]
+
+    results = ans.answer_batch([(q, hits) for q in questions], max_connections=3)
+    assert peak <= 3
+    assert results[:10] == questions[:10]
+    assert isinstance(results[10], httpx.HTTPStatusError)
+
+
+def test_search_ties_keep_corpus_order():
+    chunks = [Chunk(f"d{i:02d}.txt", 0, "shared words" if i % 7 == 0 else f"filler text {i}") for i in range(50)]
+    chunks += [Chunk("extra.txt", 0, "unrelated content")] * 20
+    index = TfidfIndex()
+    index.build(chunks)
+
+    hits = index.search("shared words", k=5)
+    assert [ch.doc_id for ch, _ in hits] == ["d00.txt", "d07.txt", "d14.txt", "d21.txt", "d28.txt"]
+
+
+def test_offline_answer_same_with_and_without_sentence_cache():
+    pipe = RAGPipeline(ROOT / "data", use_openai=False, use_cache=False)
+    pipe.build()
+    plain = OfflineAnswerer()
+
+    for q in ["What is RAG and why use it?", "TF-IDF pros and limitations", "vector database", "nothing matches zzz"]:
+        hits = pipe.index.search(q, k=4)
+        for _ in range(2):  # second pass is served from the index's sentence cache
+            assert pipe.answerer.answer(q, hits) == plain.answer(q, hits)
+    assert pipe.index._sentences
+
+
+def test_offline_answer_skips_overlap_fragments(tmp_path: Path):
+    (tmp_path / "doc.txt").write_text(
+        "Solar panels convert sunlight into power. Wind turbines convert moving air into power. "
+        "Batteries store power for later use."
+    )
+    chunks = LocalCorpus(tmp_path, chunk_size=60, chunk_overlap=25).load()
+    assert chunks[1].text.startswith("power. Wind")  # overlap fragment of chunk 0's sentence
+
+    expected = [
+        "- Solar panels convert sunlight into power. [doc.txt#0]",
+        "- Wind turbines convert moving air into power. [doc.txt#1]",
+        "- Batteries store power for later use. [doc.txt#2]",
+    ]
+    for order in (chunks, chunks[::-1]):
+        answer = OfflineAnswerer().answer("convert power", [(c, 1.0) for c in order])
+        lines = [line for line in answer.splitlines() if line.startswith("- ")]
+        assert sorted(lines) == sorted(expected)
+
+
+def test_pipeline_close_closes_openai_client(tmp_path: Path, openai_key):
+    with RAGPipeline(tmp_path, use_openai=True) as pipe:
+        client = pipe.answerer._client
+        assert not client.is_closed
+    assert client.is_closed
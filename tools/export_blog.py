@@ -1,4 +1,3 @@
-import re
 import sys
 from pathlib import Path
 
@@ -49,39 +48,56 @@ def add_code_block(doc: Document, code: str):
     font.size = Pt(10)
 
 
-def md_to_docx(doc: Document, md_body: str):
-    lines = md_body.splitlines()
+# Line kinds produced by classify_lines()
+CODE, H1, H2, H3, BULLET, BLANK, TEXT = range(7)
+
+# Prefix -> (kind, payload offset); looked up longest prefix first
+LINE_PREFIXES = {
+    "### ": (H3, 4),
+    "## ": (H2, 3),
+    "# ": (H1, 2),
+    "- ": (BULLET, 2),
+    "* ": (BULLET, 2),
+}
+
+
+def classify_lines(md_body: str):
+    """Return (kind, payload) pairs for each block of the markdown body."""
+    blocks = []
     in_code = False
     code_buf = []
-    for raw in lines:
-        line = raw.rstrip("\n")
-        if line.strip().startswith("```"):
-            if not in_code:
-                in_code = True
-                code_buf = []
-            else:
-                in_code = False
-                add_code_block(doc, "\n".join(code_buf))
+    for line in md_body.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            if in_code:
+                blocks.append((CODE, "\n".join(code_buf)))
+            in_code = not in_code
+            code_buf = []
             continue
         if in_code:
             code_buf.append(line)
             continue
-        # Headings
-        if line.startswith("### "):
-            add_heading(doc, line[4:].strip(), level=3)
-        elif line.startswith("## "):
-            add_heading(doc, line[3:].strip(), level=2)
-        elif line.startswith("# "):
-            add_heading(doc, line[2:].strip(), level=1)
-        elif line.startswith("- "):
-            # simple bullet list
-            p = doc.add_paragraph(line[2:].strip(), style="List Bullet")
-        elif line.startswith("*") and line.lstrip().startswith("* "):
-            p = doc.add_paragraph(line.lstrip()[2:].strip(), style="List Bullet")
-        elif line.strip() == "":
-            doc.add_paragraph("")
+        match = LINE_PREFIXES.get(line[:4]) or LINE_PREFIXES.get(line[:3]) or LINE_PREFIXES.get(line[:2])
+        if match:
+            kind, offset = match
+            blocks.append((kind, line[offset:].strip()))
+        elif not stripped:
+            blocks.append((BLANK, ""))
+        else:
+            blocks.append((TEXT, line))
+    return blocks
+
+
+def md_to_docx(doc: Document, md_body: str):
+    for kind, payload in classify_lines(md_body):
+        if kind == CODE:
+            add_code_block(doc, payload)
+        elif kind in (H1, H2, H3):
+            add_heading(doc, payload, level=kind - H1 + 1)
+        elif kind == BULLET:
+            doc.add_paragraph(payload, style="List Bullet")
         else:
-            doc.add_paragraph(line)
+            doc.add_paragraph(payload)
 
 
 def main():